@@ -3,15 +3,16 @@
 
 import os
 import random
+import re
 import sqlite3
 import datetime
-import asyncio
-import csv
-import urllib.request
+import functools
+import concurrent.futures
+import io
 import yaml
 import sys
 
-import isbnlib
+import aiohttp
 import discord
 from discord.ext import commands
 from discord.ext.tasks import loop
@@ -26,11 +27,120 @@ __email__ = "matt@matthewbroadbent.net"
 __status__ = "Development"
 
 
+class SQL:
+	"""SQL statements used by the bot.
+
+	Kept as constants so every call passes SQLite identical text, letting it reuse the compiled statement.
+
+	"""
+	TUNING_PRAGMAS = (
+		"PRAGMA journal_mode = WAL",
+		"PRAGMA synchronous = NORMAL",
+		"PRAGMA cache_size = -65536",
+		"PRAGMA temp_store = MEMORY",
+		"PRAGMA mmap_size = 268435456",
+	)
+	SYNCHRONOUS_OFF = "PRAGMA synchronous = OFF"
+	SYNCHRONOUS_NORMAL = "PRAGMA synchronous = NORMAL"
+	FOREIGN_KEYS_ON = "PRAGMA foreign_keys = 1"
+
+	CREATE_BOOKS = (
+		"CREATE TABLE IF NOT EXISTS books (title TEXT NOT NULL, binding TEXT NOT NULL, authors TEXT NOT NULL, series TEXT, "
+		"available INTEGER NOT NULL, isbn TEXT PRIMARY KEY, location TEXT)")
+	CREATE_USERS = (
+		"CREATE TABLE IF NOT EXISTS users (username TEXT NOT NULL, userid INTEGER PRIMARY KEY NOT NULL, banned BOOLEAN)")
+	CREATE_LOANS = (
+		"CREATE TABLE IF NOT EXISTS loans (rdate TIME, bdate TIME NOT NULL, estrdate TIME NOT NULL, returned BOOLEAN, "
+		"userid INTEGER, isbn TEXT, FOREIGN KEY (userid) REFERENCES users (userid), FOREIGN KEY (isbn) REFERENCES books ("
+		"isbn))")
+	CREATE_LOANS_USER_INDEX = "CREATE INDEX IF NOT EXISTS idx_loans_user_open ON loans (userid, returned, isbn)"
+	CREATE_LOANS_ISBN_INDEX = "CREATE INDEX IF NOT EXISTS idx_loans_isbn ON loans (isbn)"
+	CREATE_LOAN_RETURNED_TRIGGER = (
+		"CREATE TRIGGER IF NOT EXISTS trg_loan_returned AFTER UPDATE OF returned ON loans "
+		"WHEN NEW.returned IS TRUE AND OLD.returned IS FALSE "
+		"BEGIN UPDATE books SET available = available + 1 WHERE isbn = NEW.isbn; END")
+	# SQLite only keeps milliseconds, so pad rdate to the six fractional digits of Python's str(datetime)
+	CREATE_BOOK_DELETED_TRIGGER = (
+		"CREATE TRIGGER IF NOT EXISTS trg_book_deleted AFTER DELETE ON books "
+		"BEGIN UPDATE loans SET returned = TRUE, rdate = strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime') || '000' "
+		"WHERE isbn = OLD.isbn AND returned IS FALSE; END")
+	SCHEMA = (
+		CREATE_BOOKS,
+		CREATE_USERS,
+		CREATE_LOANS,
+		CREATE_LOANS_USER_INDEX,
+		CREATE_LOANS_ISBN_INDEX,
+		CREATE_LOAN_RETURNED_TRIGGER,
+		CREATE_BOOK_DELETED_TRIGGER,
+	)
+
+	INSERT_BOOK = (
+		"INSERT INTO books ('title', 'binding', 'authors', 'series', 'available', 'isbn', 'location') "
+		"VALUES (?, ?, ?, ?, ?, ?, ?)")
+	COUNT_BOOKS = "SELECT COUNT(*) FROM books"
+	BOOK_AT_OFFSET = "SELECT title, authors, series, available, isbn FROM books LIMIT 1 OFFSET ?"
+	ADD_COPIES = "UPDATE books SET available = available + ? WHERE isbn = ?"
+	TAKE_COPY = "UPDATE books SET available = available - 1 WHERE isbn = ? AND available >= 1"
+	DELETE_BOOK = "DELETE FROM books WHERE isbn = ?"
+
+	ALL_USERS = "SELECT * FROM users"
+	USER_BANNED = "SELECT banned FROM users WHERE userid = ?"
+	INSERT_USER = "INSERT OR IGNORE INTO users VALUES (?, ?, 0)"  # Concurrent first borrows may race to add a user
+	BAN_USER = "UPDATE users SET banned = TRUE WHERE userid = ?"
+	UNBAN_USER = "UPDATE users SET banned = FALSE WHERE userid = ?"
+
+	ALL_LOANS = "SELECT * FROM loans"
+	RETURNED_LOANS = "SELECT * FROM loans WHERE returned IS TRUE"
+	OUT_LOANS = "SELECT * FROM loans WHERE returned IS FALSE"
+	OVERDUE_LOANS = "SELECT * FROM loans WHERE estrdate < ? AND returned IS FALSE"
+	LOAN_COUNTS = "SELECT COUNT(*), TOTAL(isbn = ?) FROM loans WHERE userid = ? AND returned IS FALSE"
+	INSERT_LOAN = "INSERT INTO loans VALUES (NULL, ?, ?, FALSE, ?, ?)"
+	RENEW_LOAN = "UPDATE loans SET estrdate = ? WHERE isbn = ? AND userid = ?"
+	RETURN_LOAN = "UPDATE loans SET returned = TRUE, rdate = ? WHERE isbn = ? AND userid = ? AND returned IS FALSE"
+
+	LOANED_BOOKS = (
+		"SELECT books.title, books.authors, books.series, books.available, books.isbn, loans.estrdate, loans.userid "
+		"FROM loans JOIN books ON books.isbn = loans.isbn ")
+	DUE_BOOKS = LOANED_BOOKS + "WHERE loans.userid = ? AND loans.returned IS FALSE"
+	OVERDUE_BOOKS = LOANED_BOOKS + "WHERE loans.estrdate < ? AND loans.returned IS FALSE"
+
+	SEARCH_FORMATTED = (
+		"SELECT CASE WHEN available THEN '' ELSE '~~' END || '**' || title || '**' || COALESCE(' *(' || series || ')*', '') "
+		"|| ' by ' || authors || ' (' || isbn || ') — https://www.amazon.co.uk/dp/s?k=' || isbn || char(10) "
+		"|| CASE WHEN available THEN '' ELSE '~~' END FROM books WHERE ")
+	SEARCH_SCOPES = {
+		'all': '',
+		'available': ' AND available >= 1',
+		'unavailable': ' AND available = 0',
+	}
+	SEARCH_ATTRIBUTES = ('title', 'authors', 'series', 'isbn')
+
+
+SEARCH_SQL = {
+	(scope, attr): SQL.SEARCH_FORMATTED + ("TRUE" if attr == '*' else attr + " LIKE ?") + scope_filter + " ORDER BY title"
+	for scope, scope_filter in SQL.SEARCH_SCOPES.items()
+	for attr in ('*',) + SQL.SEARCH_ATTRIBUTES
+}
+
+
+class LibraryBot(commands.Bot):
+	"""Discord bot that also releases the shared HTTP session on shutdown."""
+
+	async def close(self):
+		"""Close the shared HTTP session, then the bot itself."""
+		if http_session is not None:
+			await http_session.close()
+		await super().close()
+
+
 if __name__ == '__main__':
 
 	db_path = sys.argv[1]
-	db = sqlite3.connect(db_path)
-	cursor = db.cursor()
+	db = sqlite3.connect(db_path, check_same_thread=False)
+	db.row_factory = sqlite3.Row
+	for pragma in SQL.TUNING_PRAGMAS:
+		db.execute(pragma)
+	db_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)  # SQLite work stays on one thread
 
 	TOKEN = os.getenv('DISCORD_TOKEN')
 
@@ -50,14 +160,22 @@ if __name__ == '__main__':
 	LOAN_PERIOD = int(cfg['library']['loans']['period'])
 	MAX_LOANS = int(cfg['library']['loans']['max'])
 
+	LOAD_BATCH_SIZE = 10000
+	ISBN13_PATTERN = re.compile(r'97[89][0-9]{10}')  # Bookland prefix followed by ten digits
+	MESSAGE_LIMIT = 1900  # Discord rejects messages over 2000 characters
+
 	HAPPY_EMOJI = [':grin:', ':smile:', ':smiley:', ':slight_smile:', ':grinning:']
 	SAD_EMOJI = [':sob:', ':cry:', ':worried:', ':pleading_face:', ':slight_frown:']
 
+	http_session = None
+	admin_dm = None  # DM channel with the administrator, opened on first use
+	book_count = None  # Cached for 'surprise'; reset to None whenever books are loaded or deleted
+
 	help_command = commands.DefaultHelpCommand(no_category='Commands')
 
 
 
-	bot = commands.Bot(
+	bot = LibraryBot(
 		command_prefix=commands.when_mentioned_or('?'),
 		description='A Discord bot for managing and maintaining a physical book library.',
 		help_command=help_command
@@ -68,21 +186,25 @@ if __name__ == '__main__':
 async def announce_overdue():
 	"""Periodically announce overdue books to the whole channel."""
 	channel = bot.get_channel(DISCORD_CHANNEL)
-	res = cursor.execute("SELECT isbn, estrdate, userid FROM loans WHERE estrdate < '" + str(
-		datetime.datetime.now()) + "' AND returned IS FALSE;").fetchall()
+	res = await db_fetchall(SQL.OVERDUE_BOOKS, (str(datetime.datetime.now()),))
 	books = due_books_preparse(res)
-	await channel.send('**Reminder of Outstanding Books**')
+	messages = ['**Reminder of Outstanding Books**']
 	for book in books:
-		mes = '*' + book[0][0] + '* — **' + str(abs(book[2])) + ' day(s) overdue!** ' + random.choice(
-			SAD_EMOJI) + ' <@' + str(book[3]) + '>'
-		await channel.send(mes)
-	await channel.send("Please message <@" + str(ADMIN_USER) + "> if you think there is an error or a mistake.")
+		messages.append('*' + book[0]['title'] + '* — **' + str(abs(book[2])) + ' day(s) overdue!** ' + random.choice(
+			SAD_EMOJI) + ' <@' + str(book[3]) + '>')
+	messages.append("Please message <@" + str(ADMIN_USER) + "> if you think there is an error or a mistake.")
+	for chunk in chunk_messages(messages):
+		await channel.send(chunk)
 
 
 @bot.event
 async def on_ready():
-	"""Start timed functions on ready."""
-	announce_overdue.start()
+	"""Start timed functions and open the shared HTTP session on ready."""
+	global http_session
+	if http_session is None:
+		http_session = aiohttp.ClientSession()
+	if not announce_overdue.is_running():
+		announce_overdue.start()
 
 
 @bot.command(name='init', pass_context=True, hidden=True)
@@ -100,16 +222,7 @@ async def init(ctx, path: str = 'books.csv'):
 
 	"""
 	if await auth_check(ctx) and channel_check(ctx):
-		db.execute("PRAGMA foreign_keys = 1")
-		cursor.execute(
-			"CREATE TABLE IF NOT EXISTS books (title TEXT NOT NULL, binding TEXT NOT NULL, authors TEXT NOT NULL, series TEXT, "
-			"available INTEGER NOT NULL, isbn TEXT PRIMARY KEY, location TEXT)")
-		cursor.execute(
-			"CREATE TABLE IF NOT EXISTS users (username TEXT NOT NULL, userid INTEGER PRIMARY KEY NOT NULL, banned BOOLEAN)")
-		cursor.execute(
-			"CREATE TABLE IF NOT EXISTS loans (rdate TIME, bdate TIME NOT NULL, estrdate TIME NOT NULL, returned BOOLEAN, "
-			"userid INTEGER, isbn TEXT, FOREIGN KEY (userid) REFERENCES users (userid), FOREIGN KEY (isbn) REFERENCES books ("
-			"isbn))")
+		await db_run(create_schema, True)
 		await bot.wait_until_ready()
 		await ctx.invoke(bot.get_command('load'), path=path)
 		await respond(ctx, ['Bot successfully initialised.'], admin=True)
@@ -123,28 +236,114 @@ async def load(ctx, path: str = 'books.csv'):
 		ctx: Discord message content
 		path: Path of file to load books from.
 	"""
+	global book_count
 	if await auth_check(ctx) and await channel_check(ctx):
+		import csv
 		with open(path) as csv_file:
 			csv_reader = csv.reader(csv_file, delimiter=',')
-			line_count = 0
+			next(csv_reader, None)  # Skip the header row
+			rows = []
+			invalid = []
 			for row in csv_reader:
-				if line_count == 0:
-					line_count += 1
+				isbn = row[5]
+				if is_isbn13(isbn):
+					rows.append(tuple(x or None for x in row[:-1]))  # Convert empty values into None types
 				else:
-					row = [None if x == '' else x for x in row]  # Convert empty values into None types
-					isbn = row[5]
-					if isbnlib.is_isbn13(isbn):
-						try:
-							cursor.execute("""
-													INSERT INTO books ('title', 'binding', 'authors', 'series', 'available', 'isbn', 'location')
-													VALUES (?, ?, ? ,? ,? ,?, ?)""", row[:-1])
-							line_count += 1
-						except sqlite3.IntegrityError:
-							await respond(ctx, ['Duplicate book found.'], admin=True)
-					else:
-						await respond(ctx, ['Invalid ISBN.'], admin=True)
+					invalid.append(isbn)
+		loaded, duplicates = await db_run(insert_books, rows)
+		book_count = None
+		messages = ['Load complete.', 'Loaded ' + str(loaded) + ' books, skipped ' + str(len(invalid)) + ' invalid and ' + str(
+			len(duplicates)) + ' duplicate.']
+		messages.extend('Invalid ISBN: ' + isbn for isbn in invalid)
+		messages.extend('Duplicate book found: ' + isbn for isbn in duplicates)
+		await respond(ctx, messages, admin=True)
+
+
+def is_isbn13(isbn):
+	"""Check whether a string is a valid, unhyphenated ISBN-13.
+
+	Args:
+		isbn: string to check.
+
+	Returns:
+		True if the string is thirteen digits with a 978 or 979 prefix and a correct check digit, False otherwise.
+
+	"""
+	if not ISBN13_PATTERN.fullmatch(isbn):
+		return False
+	# Weighted sum of the ASCII codes; the '0' offsets add up to 25 * 48, a multiple of 10, so they can be left in
+	digits = isbn.encode('ascii')
+	return (sum(digits[0::2]) + 3 * sum(digits[1::2])) % 10 == 0
+
+
+def create_schema(foreign_keys=False):
+	"""Create the database tables, indexes and triggers if they don't already exist.
+
+	Args:
+		foreign_keys: also enable foreign key enforcement on the connection.
+
+	"""
+	if foreign_keys:
+		db.execute(SQL.FOREIGN_KEYS_ON)
+	for statement in SQL.SCHEMA:
+		db.execute(statement)
+
+
+def insert_books(rows):
+	"""Insert book records in batches within a single transaction.
+
+	Args:
+		rows: book records to insert.
+
+	Returns:
+		The number of books inserted and the ISBNs of any duplicates skipped.
+
+	"""
+	loaded = 0
+	duplicates = []
+	db.execute(SQL.SYNCHRONOUS_OFF)  # Relax durability for the bulk import
+	db.execute("BEGIN")
+	try:
+		for start in range(0, len(rows), LOAD_BATCH_SIZE):
+			inserted, skipped = insert_book_batch(rows[start:start + LOAD_BATCH_SIZE])
+			loaded += inserted
+			duplicates.extend(skipped)
 		db.commit()
-		await respond(ctx, ['Load complete.', 'Loaded ' + str(line_count - 1) + ' books.'], admin=True)
+	except Exception:
+		db.rollback()
+		raise
+	finally:
+		db.execute(SQL.SYNCHRONOUS_NORMAL)
+	return loaded, duplicates
+
+
+def insert_book_batch(batch):
+	"""Insert a batch of book records in a single statement.
+
+	Falls back to inserting row by row if the batch contains a duplicate, so a single clash doesn't lose the batch.
+
+	Args:
+		batch: book records to insert.
+
+	Returns:
+		The number of books inserted and the ISBNs of any duplicates skipped.
+
+	"""
+	db.execute("SAVEPOINT book_batch")
+	try:
+		db.executemany(SQL.INSERT_BOOK, batch)
+		db.execute("RELEASE book_batch")
+		return len(batch), []
+	except sqlite3.IntegrityError:
+		db.execute("ROLLBACK TO book_batch")
+	duplicates = []
+	for row in batch:
+		try:
+			db.execute(SQL.INSERT_BOOK, row)
+		except sqlite3.IntegrityError:
+			duplicates.append(row[5])
+	db.execute("RELEASE book_batch")
+	return len(batch) - len(duplicates), duplicates
 
 
 @bot.command(pass_context=True, name='search')
@@ -175,19 +374,10 @@ async def search(ctx, scope: str = 'all', attr: str = '*', value: str = '*'):
 		res = []
 		if attr == 'author':
 			attr = 'authors'
-		if scope == 'all':
-			if attr == '*':
-				res = cursor.execute("SELECT * FROM books ORDER BY title").fetchall()
-			else:
-				res = cursor.execute(
-					"SELECT * FROM books WHERE " + attr + " LIKE '%" + value + "%' ORDER BY title;").fetchall()
-		elif scope == 'available':
-			res = cursor.execute(
-				"SELECT * FROM books WHERE " + attr + " LIKE '%" + value + "%' AND available >= 1 ORDER BY title;").fetchall()
-		elif scope == 'unavailable':
-			res = cursor.execute(
-				"SELECT * FROM books WHERE " + attr + " LIKE '%" + value + "%' AND available = 0 ORDER BY title;").fetchall()
-		res = format_book_records(res)
+		sql = SEARCH_SQL.get((scope, attr))
+		if sql is not None:
+			params = () if attr == '*' else ('%' + value + '%',)
+			res = [book for (book,) in await db_fetchall(sql, params)]  # Already formatted by SQL.SEARCH_FORMATTED
 		await respond(ctx, res, dm=True)
 
 
@@ -204,23 +394,22 @@ async def loans(ctx, scope: str = 'all'):
 	if await auth_check(ctx) and await channel_check(ctx):
 		res = []
 		if scope == 'all':
-			res = cursor.execute("SELECT * FROM loans").fetchall()
+			res = await db_fetchall(SQL.ALL_LOANS)
 		if scope == 'returned':
-			res = cursor.execute("SELECT * FROM loans WHERE returned IS TRUE").fetchall()
+			res = await db_fetchall(SQL.RETURNED_LOANS)
 		if scope == 'out':
-			res = cursor.execute("SELECT * FROM loans WHERE returned IS FALSE").fetchall()
+			res = await db_fetchall(SQL.OUT_LOANS)
 		if scope == 'overdue':
-			res = cursor.execute("SELECT * FROM loans WHERE estrdate < '" + str(
-				datetime.datetime.now()) + "' AND returned IS FALSE;").fetchall()
-		await respond(ctx, res, dm=True, fast=True)
+			res = await db_fetchall(SQL.OVERDUE_LOANS, (str(datetime.datetime.now()),))
+		await respond(ctx, [tuple(loan) for loan in res], dm=True, fast=True)
 
 
 @bot.command(name='users', pass_context=True, hidden=True)
 async def users_(ctx):
 	"""Fetch a list of users."""
 	if await auth_check(ctx) and await channel_check(ctx):
-		users = cursor.execute("SELECT * FROM users").fetchall()
-		await respond(ctx, users, admin=True, fast=True)
+		users = await db_fetchall(SQL.ALL_USERS)
+		await respond(ctx, [tuple(user) for user in users], admin=True, fast=True)
 
 
 @bot.command(name='version', pass_context=True, hidden=True)
@@ -241,8 +430,7 @@ async def about(ctx, ):
 async def tutorial(ctx, ):
 	"""Get a short tutorial on how to use this library."""
 	if await channel_check(ctx):
-		for message in TUTORIAL:
-			await respond(ctx, [message], dm=True)
+		await respond(ctx, TUTORIAL, dm=True)
 
 
 @bot.command(name='issue', pass_context=True, help='Report an issue to the administrator')
@@ -254,8 +442,7 @@ async def issue_(ctx, *args):
 
 	"""
 	if await channel_check(ctx):
-		user_id = str(ctx.message.author.id)
-		user = await bot.fetch_user(int(user_id))
+		user = ctx.message.author
 		message = " ".join(args)
 		await respond(ctx, ["Thanks! You're issue has been forwarded to the administrator " + random.choice(HAPPY_EMOJI)])
 		await respond(ctx, ['Issue reported by: ' + str(user), message], admin=True)
@@ -275,46 +462,60 @@ async def borrow(ctx, isbn: str):
 	"""
 	if await channel_check(ctx):
 		user_id = ctx.message.author.id
-		user = str(await bot.fetch_user(user_id))
-		res = cursor.execute("SELECT * FROM users WHERE userid = '" + str(user_id) + "';").fetchone()
+		user = str(ctx.message.author)
+		res = await db_fetchone(SQL.USER_BANNED, (user_id,))
 		messages = []
 		if res is None:
 			messages.append('Welcome to the library <@' + str(user_id) + '>! ' + random.choice(HAPPY_EMOJI))
-			cursor.execute("INSERT INTO users VALUES ('" + str(user) + "'," + str(user_id) + ", 0)")
-			db.commit()
-		elif res[2]:
+			await db_commit((SQL.INSERT_USER, (user, user_id)))
+		elif res['banned']:
 			await respond(ctx, ["It looks like you're banned from borrowing books! " + random.choice(SAD_EMOJI),
 								"Please message <@" + str(ADMIN_USER) + "> if you think there is an error or a mistake.\n"])
 			return
-		unique_loan = len(cursor.execute(
-			"SELECT userid FROM loans WHERE userid = '" + str(user_id) + "' AND isbn = '" + str(
-				isbn) + "' AND returned IS FALSE;").fetchall())
-		if unique_loan == 0:
-			current_loans = len(cursor.execute(
-				"SELECT isbn FROM loans WHERE userid = '" + str(user_id) + "' AND returned IS FALSE;").fetchall())
-			if current_loans < MAX_LOANS:
-				available = cursor.execute(
-					"SELECT * FROM books WHERE isbn IS '" + isbn + "' AND available >= 1;").fetchone()
-				if available is not None:
-					cursor.execute(
-						"UPDATE books SET available = available - 1 WHERE isbn IS '" + isbn + "' AND available >= 1;")
-					cursor.execute("INSERT INTO loans VALUES (NULL, '" + str(datetime.datetime.now()) + "', '" + str(
-						datetime.datetime.now() + datetime.timedelta(days=LOAN_PERIOD)) + "', FALSE, " + str(
-						user_id) + ", '" + isbn + "');")
-					db.commit()
-					messages.append('Great! The book is yours. ' + random.choice(HAPPY_EMOJI))
-					messages.append(BORROW_MESSAGE)
-					await respond(ctx, ["New Loan from " + user, isbn], admin=True)
-				else:
-					messages.append("I'm sorry, that book isn't available. " + random.choice(SAD_EMOJI))
-			else:
-				messages.append("I'm sorry, it looks like you've reached your loan limit. " + random.choice(SAD_EMOJI))
+		outcome = await db_run(take_loan, user_id, isbn)
+		if outcome == 'loaned':
+			messages.append('Great! The book is yours. ' + random.choice(HAPPY_EMOJI))
+			messages.append(BORROW_MESSAGE)
+			await respond(ctx, ["New Loan from " + user, isbn], admin=True)
+		elif outcome == 'unavailable':
+			messages.append("I'm sorry, that book isn't available. " + random.choice(SAD_EMOJI))
+		elif outcome == 'limit':
+			messages.append("I'm sorry, it looks like you've reached your loan limit. " + random.choice(SAD_EMOJI))
 		else:
 			messages.append(
 				"Sorry, you can't borrow that; it looks like you already have a copy on loan!  " + random.choice(SAD_EMOJI))
 		await respond(ctx, messages, dm=True)
 
 
+def take_loan(user_id, isbn):
+	"""Loan a copy of a book to a user, checking and recording the loan in a single transaction.
+
+	Args:
+		user_id: the ID of the user borrowing the book.
+		isbn: ISBN number of the book to borrow.
+
+	Returns:
+		'loaned' on success, otherwise 'duplicate', 'limit' or 'unavailable' to explain why the loan was refused.
+
+	"""
+	db.execute("BEGIN IMMEDIATE")
+	try:
+		current_loans, unique_loan = db.execute(SQL.LOAN_COUNTS, (isbn, user_id)).fetchone()
+		if unique_loan != 0:
+			return 'duplicate'
+		if current_loans >= MAX_LOANS:
+			return 'limit'
+		if db.execute(SQL.TAKE_COPY, (isbn,)).rowcount != 1:
+			return 'unavailable'
+		now = datetime.datetime.now()
+		db.execute(SQL.INSERT_LOAN, (str(now), str(now + datetime.timedelta(days=LOAN_PERIOD)), user_id, isbn))
+		db.commit()
+		return 'loaned'
+	finally:
+		if db.in_transaction:
+			db.rollback()
+
+
 @bot.command(name='desc', pass_context=True, help='Show a short description for a book')
 async def desc(ctx, isbn: str):
 	"""Show a short description for a book.
@@ -324,7 +525,7 @@ async def desc(ctx, isbn: str):
 
 	"""
 	if await channel_check(ctx):
-		description = isbnlib.desc(isbn)
+		description = await bot.loop.run_in_executor(None, cached_desc, isbn)
 		if description:
 			await respond(ctx, ["Here's a brief description of the book:", description])
 		else:
@@ -341,27 +542,81 @@ async def cover(ctx, isbn: str):
 
 	"""
 	if await channel_check(ctx):
-		try:
-			cover_url = isbnlib.cover(isbn)['smallThumbnail']
-			url_hash = str(hash(cover_url)) + '.jpg'
-			urllib.request.urlretrieve(cover_url, url_hash)
-			with open(url_hash, 'rb') as f:
-				picture = discord.File(f)
-				await ctx.send(file=picture)
-			os.remove(url_hash)
-		except KeyError:
+		cover_url = await bot.loop.run_in_executor(None, cached_cover_url, isbn)
+		data = None
+		if cover_url:
+			async with http_session.get(cover_url) as response:
+				if response.status == 200:
+					data = await response.read()
+		if data:
+			picture = discord.File(io.BytesIO(data), filename='cover.jpg')
+			await ctx.send(file=picture)
+		else:
 			await respond(ctx, [
 				"Sorry, we couldn't find an image of that book's cover " + random.choice(SAD_EMOJI)])
 
 
+@functools.lru_cache(maxsize=4096)
+def cached_desc(isbn):
+	"""Look up a short description for a book, remembering the result.
+
+	Args:
+		isbn: ISBN number of the book.
+
+	Returns:
+		The description, or an empty value if none could be found.
+
+	"""
+	import isbnlib  # Imported on first use; it pulls in many metadata backends
+	return isbnlib.desc(isbn)
+
+
+@functools.lru_cache(maxsize=4096)
+def cached_cover_url(isbn):
+	"""Look up the URL of a small cover image for a book, remembering the result.
+
+	Args:
+		isbn: ISBN number of the book.
+
+	Returns:
+		The URL of the image, or None if no cover could be found.
+
+	"""
+	import isbnlib  # Imported on first use; it pulls in many metadata backends
+	return (isbnlib.cover(isbn) or {}).get('smallThumbnail')
+
+
 @bot.command(name='surprise', pass_context=True, help='Display a random book from the library')
 async def surprise(ctx):
 	"""Display a random book from the library."""
+	global book_count
 	if await channel_check(ctx):
-		book = cursor.execute("SELECT * FROM books ORDER BY RANDOM() LIMIT 1;").fetchone()
+		book, book_count = await db_run(random_book, book_count)
+		if book is None:
+			await respond(ctx, ["Sorry, there aren't any books in the library yet " + random.choice(SAD_EMOJI)])
+			return
 		await respond(ctx, format_book_records([book]))
-		await ctx.invoke(bot.get_command('desc'), isbn=book[5])
-		await ctx.invoke(bot.get_command('cover'), isbn=book[5])
+		await ctx.invoke(bot.get_command('desc'), isbn=book['isbn'])
+		await ctx.invoke(bot.get_command('cover'), isbn=book['isbn'])
+
+
+def random_book(count):
+	"""Fetch a random book, counting the books again if the cached count is missing or out of date.
+
+	Args:
+		count: cached number of books in the library, or None if unknown.
+
+	Returns:
+		A random book (None if the library is empty) and the up to date number of books.
+
+	"""
+	if count is None:
+		(count,) = db.execute(SQL.COUNT_BOOKS).fetchone()
+	book = db.execute(SQL.BOOK_AT_OFFSET, (random.randrange(count),)).fetchone() if count else None
+	if book is None and count:  # Books were removed since the count was taken
+		(count,) = db.execute(SQL.COUNT_BOOKS).fetchone()
+		book = db.execute(SQL.BOOK_AT_OFFSET, (random.randrange(count),)).fetchone() if count else None
+	return book, count
 
 
 @bot.command(name='due', pass_context=True, help='Check which books you have loaned and when they are due')
@@ -375,8 +630,7 @@ async def due(ctx):
 	"""
 	if await channel_check(ctx):
 		user_id = ctx.message.author.id
-		res = cursor.execute(
-			"SELECT isbn, estrdate, userid FROM loans WHERE userid = '" + str(user_id) + "' AND returned IS FALSE;").fetchall()
+		res = await db_fetchall(SQL.DUE_BOOKS, (user_id,))
 		if len(res) == 0:
 			await respond(ctx, [
 				"It looks like you don't have any books loaned to you at the moment " + random.choice(SAD_EMOJI) + "\n",
@@ -389,14 +643,18 @@ async def due(ctx):
 
 
 def due_books_preparse(res):
-	"""Pre-parse and process results for due or overdue books"""
+	"""Pre-parse and process results for due or overdue books.
+
+	Args:
+		res: book records joined with the estimated return date and user ID of their loan.
+
+	"""
 	books = []
-	for (isbn, estrdate, userid) in res:
-		book = cursor.execute("SELECT * FROM books WHERE isbn = '" + isbn + "';").fetchone()
-		date_obj = datetime.datetime.strptime(estrdate, '%Y-%m-%d %H:%M:%S.%f')
+	for book in res:
+		date_obj = datetime.datetime.strptime(book['estrdate'], '%Y-%m-%d %H:%M:%S.%f')
 		return_date = date_obj.date()
 		remaining = (date_obj - datetime.datetime.now()).days + 1
-		books.append((book, return_date, remaining, userid))
+		books.append((book, return_date, remaining, book['userid']))
 	return books
 
 @bot.command(name='renew', pass_context=True, hidden=True)
@@ -412,9 +670,7 @@ async def renew(ctx, isbn: str, userid: str, days: int):
 	"""
 	if await auth_check(ctx) and await channel_check(ctx):
 		new_date = datetime.datetime.now() + datetime.timedelta(days=days)
-		cursor.execute("UPDATE loans SET estrdate = '" + str(
-			new_date) + "' WHERE isbn IS '" + isbn + "' AND userid IS '" + userid + "';")
-		db.commit()
+		await db_commit((SQL.RENEW_LOAN, (str(new_date), isbn, userid)))
 		await respond(ctx, ['Book renewed.'], admin=True)
 
 
@@ -430,8 +686,7 @@ async def ban(ctx, userid: str):
 
 	"""
 	if await auth_check(ctx) and await channel_check(ctx):
-		cursor.execute("UPDATE users SET banned = TRUE WHERE userid IS '" + userid + "';")
-		db.commit()
+		await db_commit((SQL.BAN_USER, (userid,)))
 		await respond(ctx, ['User banned.'], admin=True)
 
 
@@ -447,8 +702,7 @@ async def unban(ctx, userid: str):
 
 	"""
 	if await auth_check(ctx) and await channel_check(ctx):
-		cursor.execute("UPDATE users SET banned = FALSE WHERE userid IS '" + userid + "';")
-		db.commit()
+		await db_commit((SQL.UNBAN_USER, (userid,)))
 		await respond(ctx, ['User unbanned.'], admin=True)
 
 
@@ -463,8 +717,7 @@ async def add(ctx, isbn: str, count: int = 1):
 
 	"""
 	if await auth_check(ctx) and await channel_check(ctx):
-		cursor.execute("UPDATE books SET available = available + '" + str(count) + "' WHERE isbn IS '" + isbn + "';")
-		db.commit()
+		await db_commit((SQL.ADD_COPIES, (count, isbn)))
 		await respond(ctx, ['Book count modified.'], admin=True)
 
 
@@ -491,12 +744,10 @@ async def delete(ctx, isbn: str):
 		isbn: ISBN of the book you want to delete.
 
 	"""
+	global book_count
 	if await auth_check(ctx) and await channel_check(ctx):
-		cursor.execute(
-			"UPDATE loans SET returned = TRUE, rdate = '" + str(datetime.datetime.now()) + "' WHERE isbn IS '" +
-			isbn + "';")
-		cursor.execute("DELETE FROM books WHERE isbn IS '" + isbn + "';")
-		db.commit()
+		await db_commit((SQL.DELETE_BOOK, (isbn,)))  # trg_book_deleted closes any open loans
+		book_count = None
 		await respond(ctx, ['Book deleted.'], admin=True)
 
 
@@ -511,14 +762,70 @@ async def return_(ctx, isbn: str, userid: int):
 
 	"""
 	if await auth_check(ctx) and await channel_check(ctx):
-		cursor.execute("UPDATE books SET available = available + 1 WHERE isbn IS '" + isbn + "';")
-		cursor.execute(
-			"UPDATE loans SET returned = TRUE, rdate = '" + str(datetime.datetime.now()) + "' WHERE isbn IS '" +
-			isbn + "' AND userid IS '" + str(userid) + "';")
-		db.commit()
+		await db_commit((SQL.RETURN_LOAN, (str(datetime.datetime.now()), isbn, userid)))  # trg_loan_returned restocks
 		await respond(ctx, ['Book successfully returned. It should now be available again to borrow.'])
 
 
+async def db_run(fn, *args):
+	"""Run a function that uses the database on the dedicated database thread.
+
+	Args:
+		fn: function to run.
+		args: arguments to pass to the function.
+
+	Returns:
+		The return value of the function.
+
+	"""
+	return await bot.loop.run_in_executor(db_executor, functools.partial(fn, *args))
+
+
+async def db_fetchall(sql, params=()):
+	"""Fetch every row returned by a query, without blocking the event loop.
+
+	Args:
+		sql: query to execute.
+		params: values for the query's placeholders.
+
+	Returns:
+		A list of rows.
+
+	"""
+	return await db_run(lambda: db.execute(sql, params).fetchall())
+
+
+async def db_fetchone(sql, params=()):
+	"""Fetch the first row returned by a query, without blocking the event loop.
+
+	Args:
+		sql: query to execute.
+		params: values for the query's placeholders.
+
+	Returns:
+		The first row, or None if there were no results.
+
+	"""
+	return await db_run(lambda: db.execute(sql, params).fetchone())
+
+
+async def db_commit(*statements):
+	"""Execute statements and commit them together, without blocking the event loop.
+
+	Args:
+		statements: (sql, params) pairs to execute in order.
+
+	"""
+	def execute():
+		try:
+			for sql, params in statements:
+				db.execute(sql, params)
+			db.commit()
+		except sqlite3.Error:
+			db.rollback()
+			raise
+	await db_run(execute)
+
+
 async def respond(ctx, messages: list, dm: bool = False, admin: bool = False, fast: bool = False):
 	"""Respond to a client by sending them messages.
 
@@ -531,23 +838,54 @@ async def respond(ctx, messages: list, dm: bool = False, admin: bool = False, fa
 		messages: a list of messages to send.
 		dm: send via direct message rather than the existing channel.
 		admin: send via direct message to the administrator instead.
-		fast: send as quickly as possible without typing indicator.
+		fast: send without a typing indicator.
 
 	"""
+	global admin_dm
 	if admin is True:
-		admin_user = await bot.fetch_user(int(ADMIN_USER))
-		channel = await admin_user.create_dm()
+		if admin_dm is None:
+			admin_user = bot.get_user(int(ADMIN_USER)) or await bot.fetch_user(int(ADMIN_USER))
+			admin_dm = await admin_user.create_dm()
+		channel = admin_dm
 	elif dm is True:
 		channel = await ctx.message.author.create_dm()
 	else:
 		channel = ctx
+	chunks = chunk_messages(messages)
+	if fast is not True:
+		async with channel.typing():
+			for chunk in chunks:
+				await channel.send(chunk)
+	else:
+		for chunk in chunks:
+			await channel.send(chunk)
+
+
+def chunk_messages(messages):
+	"""Pack messages together so they can be sent in as few Discord messages as possible.
+
+	Args:
+		messages: a list of messages to pack.
+
+	Returns:
+		A list of newline separated chunks, each within the Discord message limit unless a single message exceeds it.
+
+	"""
+	chunks = []
+	chunk = ''
 	for message in messages:
-		if fast is not True:
-			async with channel.typing():
-				await asyncio.sleep(0.5)
-				await channel.send(message)
+		message = str(message)
+		if chunk and len(chunk) + len(message) + 1 > MESSAGE_LIMIT:
+			chunks.append(chunk)
+			chunk = message
+		elif chunk:
+			chunk = chunk + '\n' + message
 		else:
-			await channel.send(message)
+			chunk = message
+	if chunk:
+		chunks.append(chunk)
+	return chunks
+
 
 async def channel_check(ctx):
 	"""Confirm if the command originates from a specific channel.
@@ -579,8 +917,7 @@ async def auth_check(ctx):
 		return True
 	else:
 		await respond(ctx, ['Authentication failure.'])
-		user = await bot.fetch_user(user_id)
-		await respond(ctx, ['Failed authentication attempt from: ' + str(user)], admin=True)
+		await respond(ctx, ['Failed authentication attempt from: ' + str(ctx.message.author)], admin=True)
 		return False
 
 
@@ -596,33 +933,27 @@ def format_book_records(books, display_due_details=False):
 
 	"""
 	pretty_books = []
-	remaining = 0
+	happy = random.choice(HAPPY_EMOJI)
+	sad = random.choice(SAD_EMOJI)
+	renew_notice = f"Please message <@{ADMIN_USER}> or post in <#{DISCORD_CHANNEL}> to renew the loan.\n"
 	for book in books:
-		return_date = ''
 		if display_due_details:
-			return_date = book[1]
-			remaining = int(book[2])
-			book = book[0]
-		if book[3] is not None:
-			pretty_book = "**" + book[0] + "** *(" + book[3] + ")* by " + book[2] + " (" + str(book[5]) + ")"
-		else:
-			pretty_book = "**" + book[0] + "** by " + book[2] + " (" + str(book[5]) + ")"
+			book, return_date, remaining = book[0], book[1], int(book[2])
+		series = f" *({book['series']})*" if book['series'] is not None else ""
+		pretty_book = f"**{book['title']}**{series} by {book['authors']} ({book['isbn']})"
 		if display_due_details:
-			pretty_book = pretty_book + "\nDue: " + str(return_date) + " "
 			if remaining <= 0:
-				pretty_book = pretty_book + " — **" + str(abs(remaining)) + " day(s) overdue!** " + random.choice(
-					SAD_EMOJI) + "\n"
-				pretty_book = pretty_book + "Please message <@" + str(
-					ADMIN_USER) + '> or post in <#' + str(DISCORD_CHANNEL) + '> to renew the loan.\n'
+				pretty_book = (f"{pretty_book}\nDue: {return_date}  — **{abs(remaining)} day(s) overdue!** {sad}\n"
+					f"{renew_notice}")
 			else:
-				pretty_book = pretty_book + " — " + str(remaining) + " day(s) remaining " + random.choice(
-					HAPPY_EMOJI) + "\n"
+				pretty_book = f"{pretty_book}\nDue: {return_date}  — {remaining} day(s) remaining {happy}\n"
 		else:
-			pretty_book = pretty_book + " — https://www.amazon.co.uk/dp/s?k=" + str(book[5]) + "\n"
-			if not book[4]:
-				pretty_book = "~~" + pretty_book + "~~"
+			pretty_book = f"{pretty_book} — https://www.amazon.co.uk/dp/s?k={book['isbn']}\n"
+			if not book['available']:
+				pretty_book = f"~~{pretty_book}~~"
 		pretty_books.append(pretty_book)
 	return pretty_books
 
 
+create_schema()  # Brings databases created by older versions up to date
 bot.run(TOKEN)